@@ -1,110 +1,215 @@
 import os
+import orjson
 import requests
 import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from multiprocessing import Pool, cpu_count
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from html import unescape
+from itertools import product
 from datetime import datetime, timezone
-from dateutil import parser
 
 OUTPUT_PATH = os.environ.get("OUTPUT_PATH", "docs/calendar.ics")
 API_URL = os.environ.get("ENGAGE_API_URL")        # Full Engage URL with query params
 API_KEY = os.environ.get("ENGAGE_API_KEY", "")   # X-Engage-Api-Key
 TIMEZONE_HINT = os.environ.get("TIMEZONE_HINT", "UTC")
+FETCH_WORKERS = 4   # Concurrent page requests; kept small to respect rate limits
+PAGE_SIZE = 50      # You can adjust; 50 is safe
+
+# Per-page Engage ETags from the last run, kept next to the calendar
+ETAG_PATH = os.path.join(os.path.dirname(OUTPUT_PATH), "etag.txt")
+# Set to rebuild even when Engage reports nothing has changed
+FORCE_REBUILD = os.environ.get("FORCE_REBUILD", "").lower() in ("1", "true", "yes")
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_WS_RE = re.compile(r'\s+')
+_NONASCII_RE = re.compile(r'[^\x00-\x7f]+')
+_ICAL_TABLE = str.maketrans({
+    "\\": "\\\\",
+    ",": "\\,",
+    ";": "\\;",
+    "\n": "\\n"
+})
+
+# Shared session so every page reuses the same TCP/TLS connection
+SESSION = requests.Session()
+SESSION.headers.update({
+    "accept": "application/json",
+    "X-Engage-Api-Key": API_KEY
+})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
 
 
 # --------------------------------------------------------------------------
 # Utility Functions
 # --------------------------------------------------------------------------
 
+@lru_cache(maxsize=4096)
 def zulu(dt_str):
     """Convert Engage ISO timestamps to UTC Zulu format."""
     if not dt_str:
         return None
-    dt = parser.isoparse(dt_str)
+    dt = datetime.fromisoformat(dt_str)
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
     dt_utc = dt.astimezone(timezone.utc)
     return dt_utc.strftime("%Y%m%dT%H%M%SZ")
 
 
+@lru_cache(maxsize=2048)
 def escape_ical(text):
     """Escape special iCal characters."""
     if not text:
         return ""
-    return (
-        text.replace("\\", "\\\\")
-            .replace(",", "\\,")
-            .replace(";", "\\;")
-            .replace("\n", "\\n")
-    )
+    return text.translate(_ICAL_TABLE)
 
 
+@lru_cache(maxsize=1024)
 def strip_html(html):
     """Remove HTML, decode entities, and strip emojis."""
     if not html:
         return ""
 
-    # Remove HTML tags
-    text = re.sub(r'<[^>]+>', '', html)
+    # Remove HTML tags (plain-text descriptions skip the regex entirely)
+    text = _TAG_RE.sub('', html) if "<" in html else html
     text = unescape(text)
 
     # Remove emojis and non-ASCII characters (Google Calendar requirement)
-    text = text.encode('ascii', 'ignore').decode()
+    if not text.isascii():
+        text = _NONASCII_RE.sub('', text)
 
     # Collapse whitespace
-    return " ".join(text.split()).strip()
+    return _WS_RE.sub(' ', text).strip()
+
+
+def fold_bytes(chunk, width=75):
+    """Fold CRLF-terminated iCal lines longer than `width` octets (RFC 5545 3.1)."""
+    out = bytearray()
+    for line in chunk.split(b"\r\n")[:-1]:
+        mv = memoryview(line)
+        start = 0
+        limit = width
+        while len(line) - start > limit:
+            end = start + limit
+            # Never split a multi-byte UTF-8 sequence across lines
+            while line[end] & 0xC0 == 0x80:
+                end -= 1
+            out += mv[start:end]
+            out += b"\r\n "
+            start = end
+            limit = width - 1   # continuation lines start with a space
+        out += mv[start:]
+        out += b"\r\n"
+    return bytes(out)
 
 
 # --------------------------------------------------------------------------
 # Fetch All Pages of Events from Engage
 # --------------------------------------------------------------------------
 
-def fetch_all_events():
-    """Engage paginates: skip, take, totalItems. We fetch all pages."""
-    headers = {
-        "accept": "application/json",
-        "X-Engage-Api-Key": API_KEY
-    }
+def fetch_page(skip, etag=None):
+    """Fetch a single page of events starting at `skip`.
+
+    With `etag`, the request is conditional and may come back 304.
+    """
+    paged_url = f"{API_URL}&skip={skip}&take={PAGE_SIZE}"
+    headers = {"If-None-Match": etag} if etag else None
+
+    resp = SESSION.get(paged_url, headers=headers, timeout=30)
+    print(f"Fetching: skip={skip}, status={resp.status_code}")
+
+    if resp.status_code not in (200, 304):
+        print("Response snippet:", resp.text[:500])
+        resp.raise_for_status()
+
+    return resp
+
+
+def fetch_all_events(etags):
+    """Engage paginates: skip, take, totalItems. Yields events from all pages in order.
+
+    Each page's ETag (or "" if Engage sent none) is appended to `etags` in
+    page order.
+    """
+    # First page tells us totalItems; the rest can be fetched concurrently
+    first = fetch_page(0)
+    etags.append(first.headers.get("ETag", ""))
+    data = orjson.loads(first.content)
+    items = data.get("items", [])
+    total = data.get("totalItems", len(items))
+    fetched = len(items)
+    yield from items
+
+    offsets = range(PAGE_SIZE, total, PAGE_SIZE)
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        # map() yields results in submission order, so events stay sorted
+        for resp in executor.map(fetch_page, offsets):
+            etags.append(resp.headers.get("ETag", ""))
+            items = orjson.loads(resp.content).get("items", [])
+            fetched += len(items)
+            yield from items
 
-    events = []
-    skip = 0
-    take = 50   # You can adjust; 50 is safe
+    print(f"Fetched {fetched} events total.")
 
-    while True:
-        paged_url = f"{API_URL}&skip={skip}&take={take}"
 
-        resp = requests.get(paged_url, headers=headers, timeout=30)
-        print(f"Fetching: skip={skip}, status={resp.status_code}")
+def pages_unchanged(etags):
+    """Conditionally re-request every page; True only if all come back 304."""
+    if not etags or not all(etags):
+        return False
 
-        if resp.status_code != 200:
-            print("Response snippet:", resp.text[:500])
-            resp.raise_for_status()
+    offsets = range(0, len(etags) * PAGE_SIZE, PAGE_SIZE)
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        return all(
+            resp.status_code == 304
+            for resp in executor.map(fetch_page, offsets, etags)
+        )
 
-        data = resp.json()
 
-        items = data.get("items", [])
-        events.extend(items)
+def read_etags():
+    """Return the per-page ETags saved by the previous run, if its calendar still exists."""
+    if not (os.path.exists(OUTPUT_PATH) and os.path.exists(ETAG_PATH)):
+        return []
+    with open(ETAG_PATH, encoding="utf-8") as f:
+        return f.read().splitlines()
 
-        total = data.get("totalItems", len(items))
-        skip += take
 
-        if skip >= total:
-            break
+def write_etags(etags):
+    """Remember each page's ETag, one per line, for the next run's conditional GETs.
 
-    print(f"Fetched {len(events)} events total.")
-    return events
+    The file is always written (empty unless every page had an ETag) so the
+    workflow's commit step can rely on it existing.
+    """
+    with open(ETAG_PATH, "w", encoding="utf-8") as f:
+        if all(etags):
+            f.writelines(f"{etag}\n" for etag in etags)
 
 
 # --------------------------------------------------------------------------
-# Create VEVENT Blocks
+# Normalize Engage Events
 # --------------------------------------------------------------------------
 
-def to_vevent(e):
-    eid   = e.get("id")
-    title = e.get("name") or ""
-    desc  = strip_html(e.get("description") or "")
-    start = e.get("startsOn")
-    end   = e.get("endsOn")
-
+@dataclass(slots=True)
+class Event:
+    """The fields of an Engage event that end up in the calendar."""
+    id: str
+    title: str
+    desc: str
+    start: str | None
+    end: str | None
+    loc: str
+    url: str | None
+    cancelled: bool
+
+
+def normalize(e):
+    """Resolve an Engage event dict's fallbacks once into an Event."""
     # LOCATION formatting
     address = e.get("address") or {}
     name = address.get("name")
@@ -119,70 +224,133 @@ def to_vevent(e):
     else:
         loc = ""
 
-    # URL (Engage doesn't provide direct event link in this API)
-    url = e.get("imageUrl")
-
     # STATUS (Canceled events)
     state = e.get("state") or {}
     status = state.get("status")
-    is_cancelled = (status and status.lower() == "canceled")
 
-    dtstamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-    dtstart = zulu(start)
-    dtend   = zulu(end)
+    return Event(
+        id=e.get("id"),
+        title=e.get("name") or "",
+        desc=e.get("description") or "",
+        start=e.get("startsOn"),
+        end=e.get("endsOn"),
+        loc=loc,
+        # URL (Engage doesn't provide direct event link in this API)
+        url=e.get("imageUrl"),
+        cancelled=bool(status and status.lower() == "canceled")
+    )
 
+
+# --------------------------------------------------------------------------
+# Create VEVENT Blocks
+# --------------------------------------------------------------------------
+
+def vevent_template(has_start, has_end, has_desc, has_loc, has_url, is_cancelled):
+    """Build the VEVENT format string for one combination of optional fields."""
     lines = []
     lines.append("BEGIN:VEVENT")
-    lines.append(f"UID:{eid}@fairmontstate.edu")
-    lines.append(f"DTSTAMP:{dtstamp}")
-
-    if dtstart:
-        lines.append(f"DTSTART:{dtstart}")
-    if dtend:
-        lines.append(f"DTEND:{dtend}")
-
-    lines.append(f"SUMMARY:{escape_ical(title)}")
-    if desc:
-        lines.append(f"DESCRIPTION:{escape_ical(desc)}")
-    if loc:
-        lines.append(f"LOCATION:{escape_ical(loc)}")
-    if url:
-        lines.append(f"URL:{url}")
+    lines.append("UID:{uid}@fairmontstate.edu")
+    lines.append("DTSTAMP:{dtstamp}")
+
+    if has_start:
+        lines.append("DTSTART:{dtstart}")
+    if has_end:
+        lines.append("DTEND:{dtend}")
+
+    lines.append("SUMMARY:{summary}")
+    if has_desc:
+        lines.append("DESCRIPTION:{description}")
+    if has_loc:
+        lines.append("LOCATION:{location}")
+    if has_url:
+        lines.append("URL:{url}")
     if is_cancelled:
         lines.append("STATUS:CANCELLED")
 
     lines.append("END:VEVENT")
-    return lines
+
+    # CRLF after every line, including the last
+    return "\r\n".join(lines) + "\r\n"
+
+
+# Every event fits one of these 64 shapes, keyed by which optional fields it has
+VEVENT_TEMPLATES = {
+    flags: vevent_template(*flags)
+    for flags in product((False, True), repeat=6)
+}
+
+
+def to_vevent(ev, dtstamp):
+    desc    = strip_html(ev.desc)
+    dtstart = zulu(ev.start)
+    dtend   = zulu(ev.end)
+
+    key = (bool(dtstart), bool(dtend), bool(desc), bool(ev.loc), bool(ev.url), ev.cancelled)
+    fields = {
+        "uid": ev.id,
+        "dtstamp": dtstamp,
+        "dtstart": dtstart,
+        "dtend": dtend,
+        "summary": escape_ical(ev.title),
+        "description": escape_ical(desc),
+        "location": escape_ical(ev.loc),
+        "url": ev.url
+    }
+    return fold_bytes(VEVENT_TEMPLATES[key].format_map(fields).encode("utf-8"))
 
 
 # --------------------------------------------------------------------------
 # Build the Calendar
 # --------------------------------------------------------------------------
 
-def main():
-    if not API_URL:
-        raise SystemExit("ENGAGE_API_URL is not set!")
+CALENDAR_HEADER = (
+    b"BEGIN:VCALENDAR\r\n"
+    b"VERSION:2.0\r\n"
+    b"PRODID:-//Fairmont State//Engage iCal//EN\r\n"
+    b"CALSCALE:GREGORIAN\r\n"
+    b"METHOD:PUBLISH\r\n"
+)
+CALENDAR_FOOTER = b"END:VCALENDAR\r\n"
 
-    events = fetch_all_events()
 
-    lines = []
-    lines.append("BEGIN:VCALENDAR")
-    lines.append("VERSION:2.0")
-    lines.append("PRODID:-//Fairmont State//Engage iCal//EN")
-    lines.append("CALSCALE:GREGORIAN")
-    lines.append("METHOD:PUBLISH")
+def iter_vevents(events, dtstamp):
+    """Yield one UTF-8 VEVENT chunk per event, in event order."""
+    # Each VEVENT depends only on its own event, so convert them across
+    # processes; imap keeps the original event order and pulls events
+    # lazily, so conversion overlaps with fetching the remaining pages.
+    with Pool(cpu_count()) as pool:
+        yield from pool.imap(partial(to_vevent, dtstamp=dtstamp), events, chunksize=64)
 
-    for e in events:
-        lines.extend(to_vevent(e))
 
-    lines.append("END:VCALENDAR")
+def main():
+    if not API_URL:
+        raise SystemExit("ENGAGE_API_URL is not set!")
 
-    os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
+    # DTSTAMP is when the calendar was assembled; identical for every event
+    dtstamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
 
-    with open(OUTPUT_PATH, "w", encoding="utf-8", newline="\r\n") as f:
-        f.write("\r\n".join(lines))
+    os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
 
-    print(f"Wrote {OUTPUT_PATH} with {len(events)} events. Timezone hint: {TIMEZONE_HINT}")
+    # Skip the whole rebuild only when Engage says every page is unchanged
+    if not FORCE_REBUILD and pages_unchanged(read_etags()):
+        print(f"Engage reports no changes; keeping {OUTPUT_PATH}.")
+        return
+
+    # Fetch -> convert runs as one pipeline into a single buffer, so the
+    # calendar is only touched once every page has been fetched.
+    etags = []
+    buf = bytearray(CALENDAR_HEADER)
+    count = 0
+    for chunk in iter_vevents(map(normalize, fetch_all_events(etags)), dtstamp):
+        buf += chunk
+        count += 1
+    buf += CALENDAR_FOOTER
+
+    with open(OUTPUT_PATH, "wb") as f:
+        f.write(buf)
+    write_etags(etags)
+
+    print(f"Wrote {OUTPUT_PATH} with {count} events. Timezone hint: {TIMEZONE_HINT}")
 
 
 if __name__ == "__main__":